@@ -1,17 +1,26 @@
 import os
-import gzip
 import shutil
 import pathlib
 import logging
 from importlib import resources
 
+try:
+    from isal import igzip as gzip
+except ImportError:  # pragma: no cover
+    import gzip
+
 from . import paths
 
 _logger = logging.getLogger(__name__)
+_COPY_BUFSIZE = 1024 * 1024
 
 
 def copy_initial_data():
-    os.makedirs(paths.DATA_ROOT, exist_ok=True)
+    # bump version when chain files are added, so existing installs re-copy
+    sentinel = pathlib.Path(paths.CHAIN_DIR).joinpath('.init_v1')
+    if sentinel.exists():
+        return
+    paths.ensure_dirs()
     added_data = []
     for file_name in [
         'GRCh37_to_GRCh38.chain.gz',
@@ -30,6 +39,7 @@ def copy_initial_data():
             with resources.path('lift_coords.data', file_name) as gz_path:
                 with gzip.open(gz_path, 'rb') as gz:
                     with open(new_path, 'wb') as out:
-                        shutil.copyfileobj(gz, out)
+                        shutil.copyfileobj(gz, out, length=_COPY_BUFSIZE)
     if added_data:
         _logger.info(f"Copied reference data to {paths.DATA_ROOT}: {added_data}.")
+    sentinel.touch()
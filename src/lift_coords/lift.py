@@ -1,12 +1,36 @@
 #!/usr/bin/env python
 import os
+import io
 import shlex
+import bisect
+import functools
+import itertools
 import logging
+import tempfile
+import threading
 import subprocess
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 
+try:
+    import pyliftover
+except ImportError:  # pragma: no cover
+    pyliftover = None
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.compute as pc
+except ImportError:  # pragma: no cover
+    pa = pacsv = pc = None
+try:
+    _BED_WRITE_OPTIONS = pacsv.WriteOptions(
+        include_header=False, delimiter='\t', quoting_style='none')
+except (AttributeError, TypeError):  # pragma: no cover
+    _BED_WRITE_OPTIONS = None  # no pyarrow, or pyarrow < 11
+
 from . import paths
 from .admin import copy_initial_data
 
@@ -38,10 +62,12 @@ _CHAIN_LISTS = {
     ('hg38', 'grch38'): [_CHAIN_HG38_38],
     ('hg38', 'hg19'): [_CHAIN_HG38_HG19],
 }
+_CHAIN_INDEXES = {}  # chain_path: (mtime, chain index, see _index_chains)
+_MIN_MATCH = 0.95  # as liftOver -minMatch: min fraction of bases that remap
 
 
 def lift_over(df, build_in: str, build_out: str, keep_orig=False,
-              keep_intermediate=False):
+              keep_intermediate=False, use_subprocess=False, parallel=False):
     """Lift table of site info from one build to another.
 
     Args:
@@ -50,6 +76,12 @@ def lift_over(df, build_in: str, build_out: str, keep_orig=False,
         build_out: Name of output build.
         keep_orig (bool): whether to keep initial coordinate columns as {col}_orig.
         keep_intermediate (bool): whether to keep intermediate liftOver bed files.
+        use_subprocess (bool): run the liftOver binary instead of lifting
+            in-process with pyliftover. Used automatically if pyliftover
+            is not installed.
+        parallel (bool): run liftOver separately for each chromosome, on up to
+            one CPU each (liftOver binary only). Each process loads the full
+            chain file, so this pays off for large tables.
     Returns:
         new_table (pd.DataFrame), inds_unlifted
     """
@@ -58,7 +90,8 @@ def lift_over(df, build_in: str, build_out: str, keep_orig=False,
     new_table, unlifted = _lift_with_chains(
         df, keep_orig=keep_orig,
         chain_list=_CHAIN_LISTS[(build_in, build_out)], new_build_name='GRCh37',
-        keep_intermediate=keep_intermediate)
+        keep_intermediate=keep_intermediate, use_subprocess=use_subprocess,
+        parallel=parallel)
     return new_table, unlifted
 
 
@@ -77,7 +110,8 @@ def _prettify_build_str(build: str) -> str:
 
 
 def _lift_with_chains(df, keep_orig=False, chain_list=None,
-                      new_build_name=None, keep_intermediate=False):
+                      new_build_name=None, keep_intermediate=False,
+                      use_subprocess=False, parallel=False):
     """Lift in two steps, using two chain files (chain1, and chain2).
 
     Args:
@@ -86,125 +120,428 @@ def _lift_with_chains(df, keep_orig=False, chain_list=None,
         chain_list (list): chain file basenames, e.g. [_CHAIN_HG38_HG19,]
         new_build_name (str): OPTIONAL. name to go in new Build column
             (if input table has a build column)
+        keep_intermediate (bool): whether to keep intermediate liftOver bed
+            files (liftOver binary only).
+        use_subprocess (bool): run the liftOver binary rather than pyliftover.
+        parallel (bool): run liftOver per chromosome, concurrently (liftOver
+            binary only, ignored with keep_intermediate).
     """
     if chain_list is None:
         raise TypeError("At least one chain file is required.")
-    build_col = _match_column_str('build', df)
-    chr_col = _match_column_str('chrom', df)
-    start_col = _match_column_str('start', df)
-    end_col = _match_column_str('end', df)
+    col_lookup = _build_col_lookup(df)
+    build_col = _match_column_str('build', col_lookup)
+    chr_col = _match_column_str('chrom', col_lookup)
+    start_col = _match_column_str('start', col_lookup)
+    end_col = _match_column_str('end', col_lookup)
     end_col = end_col if end_col else start_col
-    use_cols = [chr_col, start_col, end_col]
+    chain_paths = [os.path.join(paths.CHAIN_DIR, chain) for chain in chain_list]
+
+    if not use_subprocess and pyliftover is None:
+        _logger.info('pyliftover not installed, using liftOver binary.')
+        use_subprocess = True
 
     df_orig = df
-    df = df[use_cols].copy()
+    # rows without finite positions can't lift, so are left out of lifting
+    inds = np.flatnonzero(np.isfinite(_to_float(df[start_col]))
+                          & np.isfinite(_to_float(df[end_col])))
+    chroms = df[chr_col].to_numpy()[inds]
+    starts = df[start_col].to_numpy()[inds]
+    ends = df[end_col].to_numpy()[inds]
+    if use_subprocess:
+        # bed name field holds row positions, mapped back below
+        if keep_intermediate:
+            bed = io.BytesIO()
+            _make_bed(chroms, starts, ends, inds, buf=bed)
+            current_bed = bed.getvalue()
+            paths.ensure_dirs()
+            now_str = datetime.isoformat(datetime.now())
+            keep_dir = tempfile.mkdtemp(prefix=f'lift_{now_str}_',
+                                        dir=paths.WORK_DIR)
+            _logger.info(f"Keeping intermediate files in {keep_dir}")
+            _save_intermediate(current_bed, os.path.join(keep_dir, 'in'))
+            for ind, chain_path in enumerate(chain_paths):
+                unlift_path = os.path.join(keep_dir, f'{ind}_unlifted')
+                current_bed = _lift_bed(current_bed, chain_path=chain_path,
+                                        unlifted_path=unlift_path)
+                _save_intermediate(current_bed,
+                                   os.path.join(keep_dir, f'{ind}_out'))
+            lifted_bed = _read_bed(current_bed)
+        elif parallel:
+            lifted_bed = _read_bed(_lift_bed_by_chrom(
+                chroms, starts, ends, inds, chain_paths))
+        else:
+            bed = io.BytesIO()
+            _make_bed(chroms, starts, ends, inds, buf=bed)
+            # parse lifted records straight from the last liftOver's stdout
+            lifted_bed = _lift_bed_pipeline(bed.getvalue(), chain_paths,
+                                            read_out=_read_bed)
+
+        rows = lifted_bed['ind'].to_numpy(dtype=np.int64)
+        order = np.argsort(rows, kind='stable')  # parallel output is by chrom
+        rows = rows[order]
+        new_coords = [lifted_bed[i].to_numpy()[order]
+                      for i in ('chrom', 'start', 'end')]
+    else:
+        chroms, starts, ends, lifted = _lift_in_process(
+            chroms, starts, ends, chain_paths)
+        rows = inds[lifted]
+        new_coords = [chroms[lifted], starts[lifted], ends[lifted]]
+
+    lifted = np.zeros(len(df_orig), dtype=bool)
+    lifted[rows] = True
+    unlifted = df_orig[~lifted]
+    _logger.info(f'{len(unlifted)} rows failed liftover.')
 
-    # note: index must be unique
-    df['ind'] = df.index.values
+    df2 = df_orig.take(rows)
+    coord_cols = list(dict.fromkeys([chr_col, start_col, end_col]))
+    if keep_orig:
+        orig_cols = coord_cols + [build_col] if build_col else coord_cols
+        df2.rename(columns={i: i + '_orig' for i in orig_cols}, inplace=True)
+    for col, values in zip([chr_col, start_col, end_col], new_coords):
+        df2[col] = values
+    if build_col and new_build_name:
+        df2[build_col] = new_build_name
 
-    bed_path = _make_bed(chr_col, start_col, end_col, index_col='ind',
-                         data=df, out_dir=paths.WORK_DIR)
+    return df2, unlifted
 
-    current_bed = bed_path
-    out_paths, unlift_paths = [], []
-    for ind, chain in enumerate(chain_list):
-        chain_path = os.path.join(paths.CHAIN_DIR, chain)
-        out_path, unlift_path = _lift_bed(current_bed, chain_path=chain_path,
-                                          out_dir=paths.WORK_DIR)
-        out_paths.append(out_path)
-        unlift_paths.append(unlift_path)
-        current_bed = out_path
 
-    n = pd.read_csv(current_bed, header=None, sep='\t',
-                    names=[chr_col, start_col, end_col, 'ind'])
-    n.Start_Position += 1
-    n.set_index('ind', inplace=True)
+def _get_chain_index(chain_path):
+    """Get interval index of chain file, parsing it only once.
 
-    if not keep_intermediate:
-        _logger.info('Cleaning up intermediate files.')
-        for path in out_paths + unlift_paths + [bed_path]:
-            os.remove(path)
+    The index is reused by later calls until the file is modified.
+    """
+    mtime = os.path.getmtime(chain_path)
+    cached = _CHAIN_INDEXES.get(chain_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    _logger.info(f"Loading chain file {chain_path}")
+    chain_index = _index_chains(pyliftover.LiftOver(chain_path).chain_file.chains)
+    _CHAIN_INDEXES[chain_path] = (mtime, chain_index)
+    return chain_index
 
-    df2 = df_orig.join(n, how='left', lsuffix='_orig')
 
-    unlifted = df_orig[df2.Start_Position.isnull()]
-    _logger.info(f'{len(unlifted)} rows failed liftover.')
+def _index_chains(chains):
+    """Index pyliftover chains by source chromosome, for interval queries.
 
-    df2.dropna(axis=0, how='any', subset=[start_col, end_col], inplace=True)
-    df2[start_col] = df2[start_col].astype(int)
-    df2[end_col] = df2[end_col].astype(int)
+    Returns:
+        dict of source chrom: (chain starts, running max of chain ends,
+        [(chain, block starts)]), each sorted by chain start.
+    """
+    by_chrom = {}
+    for chain in chains:
+        by_chrom.setdefault(chain.source_name, []).append(chain)
+    chain_index = {}
+    for chrom, chrom_chains in by_chrom.items():
+        chrom_chains.sort(key=lambda c: c.source_start)
+        chain_index[chrom] = (
+            [c.source_start for c in chrom_chains],
+            list(itertools.accumulate((c.source_end for c in chrom_chains), max)),
+            [(c, [block[0] for block in c.blocks]) for c in chrom_chains],
+        )
+    return chain_index
+
+
+def _lift_in_process(chroms, starts, ends, chain_paths):
+    """Lift 1-based coordinate arrays in-process, applying chains in order.
 
-    if build_col:
-        if keep_orig:
-            df2.rename(columns={build_col: build_col + '_orig'}, inplace=True)
-            if new_build_name:
-                df2[build_col] = new_build_name
-        else:
-            if new_build_name:
-                df2[build_col] = new_build_name
-            df2.drop([i + '_orig' for i in [chr_col, start_col, end_col]], axis=1,
-                     inplace=True)
+    Returns:
+        new_chroms, new_starts, new_ends, lifted (bool mask of rows whose
+        interval lifted through every chain, see _lift_interval).
+    """
+    chain_indexes = [_get_chain_index(path) for path in chain_paths]
+    n_rows = len(chroms)
+    new_chroms = np.empty(n_rows, dtype=object)
+    new_starts = np.zeros(n_rows, dtype=np.int64)
+    new_ends = np.zeros(n_rows, dtype=np.int64)
+    lifted = np.zeros(n_rows, dtype=bool)
+
+    if len(chain_indexes) == 1:
+        # most conversions use a single chain: skip the per-hop loop
+        lift = functools.partial(_lift_interval, chain_indexes[0])
+    else:
+        lift = functools.partial(_lift_through, chain_indexes)
+    for i, (chrom, start, end) in enumerate(zip(chroms, starts, ends)):
+        # 0-based half-open, as in bed files
+        interval = lift(str(chrom), int(start) - 1, int(end))
+        if interval is not None:
+            new_chroms[i] = interval[0]
+            new_starts[i] = interval[1] + 1
+            new_ends[i] = interval[2]
+            lifted[i] = True
+    return new_chroms, new_starts, new_ends, lifted
+
+
+def _lift_through(chain_indexes, chrom, start, end):
+    """Lift 0-based half-open interval through successive chain files."""
+    interval = chrom, start, end
+    for chain_index in chain_indexes:
+        interval = _lift_interval(chain_index, *interval)
+        if interval is None:
+            return None
+    return interval
+
+
+def _lift_interval(chain_index, chrom, start, end):
+    """Lift 0-based half-open interval with one chain file, as liftOver does.
+
+    Exactly one chain must align at least _MIN_MATCH of the interval's bases
+    (none: deleted in new; several: duplicated in new). The interval maps to
+    the span from its first to its last aligned base in that chain.
 
-    return df2, unlifted
+    Returns:
+        (chrom, start, end), or None if the interval does not lift.
+    """
+    if chrom not in chain_index or end <= start:
+        return None
+    chain_starts, max_ends, chains = chain_index[chrom]
+    min_aligned = _MIN_MATCH * (end - start)
+    hit = None
+    i = bisect.bisect_left(chain_starts, end) - 1
+    while i >= 0 and max_ends[i] > start:
+        chain, block_starts = chains[i]
+        i -= 1
+        if chain.source_end <= start:
+            continue
+        aligned, first, last = 0, None, None
+        j = max(bisect.bisect_right(block_starts, start) - 1, 0)
+        for block_start, block_end, target_start in itertools.islice(
+                chain.blocks, j, None):
+            if block_start >= end:
+                break
+            lo, hi = max(block_start, start), min(block_end, end)
+            if lo < hi:
+                aligned += hi - lo
+                if first is None:
+                    first = target_start + lo - block_start
+                last = target_start + hi - block_start
+        if aligned < min_aligned:
+            continue
+        if hit is not None:
+            return None
+        if chain.target_strand == '-':
+            first, last = chain.target_size - last, chain.target_size - first
+        hit = chain.target_name, first, last
+    return hit
+
+
+def _prefetch_chain(chain_path):
+    """Ask the kernel to start reading chain file into the page cache.
+
+    Readahead runs in the background while liftOver starts up. Only
+    WILLNEED is useful here: SEQUENTIAL applies to our own descriptor,
+    which is closed before liftOver opens the file.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(chain_path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
 
 
-def _lift_bed(bed_in_path, chain_path=None, out_dir=None):
-    """Lifts bed file using provided chain."""
+def _lift_bed(bed_in, chain_path=None, unlifted_path=os.devnull):
+    """Lift bed records using provided chain, streaming via stdin/stdout.
+
+    Args:
+        bed_in (bytes): bed file contents.
+        chain_path (str): path to chain file.
+        unlifted_path (str): where liftOver writes unmapped records.
+    Returns:
+        lifted bed file contents (bytes).
+    """
 
     if not chain_path:
         raise Exception("chain_path required.")
-    if not out_dir:
-        out_dir = os.getcwd()
-
-    # n_pos = len(chrom)
-    # if n_pos != len(start_pos) != len(end_pos):
-    #     raise Exception("Parameters must have same length.")
-    now_str = datetime.isoformat(datetime.now())
-    out_path = os.path.join(out_dir, f'lift_{now_str}_out')
-    unlifted_path = os.path.join(out_dir, f'lift_{now_str}_unlifted')
 
+    _prefetch_chain(chain_path)
     # liftOver oldFile map.chain newFile unMapped
-    cmd = ['liftOver', bed_in_path, chain_path, out_path, unlifted_path]
+    cmd = ['liftOver', 'stdin', chain_path, 'stdout', unlifted_path]
     _logger.info(f"Running {' '.join(shlex.quote(arg) for arg in cmd)}")
 
-    with open(os.devnull, "r") as fnullin:
-        with subprocess.Popen(cmd, stdin=fnullin, stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              universal_newlines=True) as p:
-            for line in p.stdout:
-                msg = line.rstrip('\n')
-                _logger.info(f"LIFTOVER: {msg}")
-            for line in p.stderr:
-                msg = line.rstrip('\n')
-                _logger.error(f"LIFTOVER: {msg}")
-    return out_path, unlifted_path
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE) as p:
+        bed_out, err = p.communicate(bed_in)
+    for line in err.decode().splitlines():
+        _logger.error(f"LIFTOVER: {line}")
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    return bed_out
 
 
-def _make_bed(chrom='Chromosome', start_pos='Start_Position',
-              end_pos='End_Position', index_col='ind', data=None,
-              out_dir=None):
-    """Create bed file from dataframe."""
-    if not out_dir:
-        out_dir = os.getcwd()
+def _lift_bed_pipeline(bed_in, chain_paths, read_out=None):
+    """Lift bed records through successive chains in one liftOver pipeline.
 
-    now_str = datetime.isoformat(datetime.now())
-    bedfilepath = os.path.join(out_dir, 'lift_' + now_str + '_in')
+    Each hop reads the previous hop's stdout, so later hops load their chain
+    file while earlier hops are still mapping. Unmapped records are dropped.
 
-    bed_df = data[[chrom, start_pos, end_pos, index_col]].copy()
-    bed_df[start_pos] = bed_df[start_pos] - 1
-    bed_df.to_csv(bedfilepath, sep='\t', header=False, index=False)
+    Args:
+        bed_in (bytes): bed file contents.
+        chain_paths (list): chain file paths, in lift order.
+        read_out (callable): OPTIONAL. consumes the last hop's stdout stream,
+            e.g. _read_bed. By default the stream is read into bytes.
+    Returns:
+        read_out result (default: lifted bed file contents, as bytes).
+    """
+    for chain_path in chain_paths:
+        _prefetch_chain(chain_path)
+    procs, err_files = [], []
+
+    def feed():
+        try:
+            procs[0].stdin.write(bed_in)
+        except (BrokenPipeError, ValueError):
+            pass  # liftOver exited or was killed; reported below
+        finally:
+            procs[0].stdin.close()
+
+    writer, done = None, False
+    try:
+        stdin = subprocess.PIPE
+        for chain_path in chain_paths:
+            cmd = ['liftOver', 'stdin', chain_path, 'stdout', os.devnull]
+            _logger.info(f"Running {' '.join(shlex.quote(arg) for arg in cmd)}")
+            # stderr goes to a file so a chatty hop can never block on it
+            err_files.append(tempfile.TemporaryFile())
+            p = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE,
+                                 stderr=err_files[-1])
+            if procs:
+                # only the next hop should hold the read end
+                procs[-1].stdout.close()
+            procs.append(p)
+            stdin = p.stdout
+
+        writer = threading.Thread(target=feed, daemon=True)
+        writer.start()
+        with procs[-1].stdout as stdout:
+            bed_out = read_out(stdout) if read_out else stdout.read()
+        done = True
+    finally:
+        for p in procs:
+            if not done and p.poll() is None:
+                p.kill()
+            p.wait()
+            p.stdout.close()
+        if writer is not None:
+            writer.join()
+        elif procs:
+            procs[0].stdin.close()
+        for err in err_files:
+            err.seek(0)
+            for line in err.read().decode().splitlines():
+                _logger.error(f"LIFTOVER: {line}")
+            err.close()
+
+    # a failing hop makes upstream hops die of SIGPIPE: report the last one
+    for p in reversed(procs):
+        if p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
+    return bed_out
+
+
+def _lift_bed_by_chrom(chroms, starts, ends, inds, chain_paths):
+    """Lift records in one liftOver pipeline per chromosome, concurrently.
 
-    return bedfilepath
+    Returns:
+        lifted bed file contents (bytes), grouped by chromosome.
+    """
+    codes, _ = pd.factorize(chroms)
+    order = np.argsort(codes, kind='stable')
+    groups = np.split(order, np.flatnonzero(np.diff(codes[order])) + 1)
 
+    def lift_group(rows):
+        bed = io.BytesIO()
+        _make_bed(chroms[rows], starts[rows], ends[rows], inds[rows], buf=bed)
+        return _lift_bed_pipeline(bed.getvalue(), chain_paths)
 
-def _match_column_str(val=None, df=None):
-    """Get first column which, in lowercase, contains input text."""
+    # threads suffice: the lifting itself runs in liftOver child processes
+    n_workers = min(os.cpu_count() or 1, len(groups))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return b''.join(executor.map(lift_group, groups))
 
-    matches = [i for i in df.columns if val in i.lower()]
-    if matches:
-        return matches[0]
-    else:
-        return None
+
+def _save_intermediate(bed, bed_path):
+    """Write bed contents to file."""
+    with open(bed_path, 'wb') as out:
+        out.write(bed)
+
+
+def _read_bed(bed):
+    """Parse bed records into chrom, start, end, ind columns.
+
+    Start positions are converted to 1-based.
+
+    Args:
+        bed: bed contents (bytes), or buffered binary stream such as a pipe.
+    """
+    names = ['chrom', 'start', 'end', 'ind']
+    if isinstance(bed, bytes):
+        if not bed:
+            return _empty_bed()
+        bed = pa.BufferReader(bed) if pacsv is not None else io.BytesIO(bed)
+    elif not bed.peek(1):
+        return _empty_bed()
+    if pacsv is not None:
+        table = pacsv.read_csv(
+            bed,
+            read_options=pacsv.ReadOptions(column_names=names),
+            parse_options=pacsv.ParseOptions(delimiter='\t'),
+            convert_options=pacsv.ConvertOptions(column_types={
+                'chrom': pa.string(), 'start': pa.int64(), 'end': pa.int64()}))
+        table = table.set_column(1, 'start', pc.add(table['start'], 1))
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+    bed_df = pd.read_csv(bed, header=None, sep='\t', names=names,
+                         dtype={'chrom': str})
+    bed_df['start'] += 1
+    return bed_df
+
+
+def _empty_bed():
+    """Get empty table with the columns and dtypes returned by _read_bed."""
+    return pd.DataFrame({
+        'chrom': pd.Series([], dtype=str),
+        'start': pd.Series([], dtype=np.int64),
+        'end': pd.Series([], dtype=np.int64),
+        'ind': pd.Series([], dtype=np.int64),
+    })
+
+
+def _make_bed(chroms, starts, ends, inds, buf=None):
+    """Write bed records for 1-based coordinate arrays to binary buffer."""
+    chroms = chroms.astype(str)
+    starts = starts.astype(np.int64, copy=False) - 1
+    ends = ends.astype(np.int64, copy=False)
+    if _BED_WRITE_OPTIONS is not None:
+        table = pa.table({'chrom': chroms, 'start': starts, 'end': ends,
+                          'ind': inds})
+        pacsv.write_csv(table, buf, write_options=_BED_WRITE_OPTIONS)
+        return
+    buf.writelines(
+        f'{c}\t{s}\t{e}\t{i}\n'.encode() for c, s, e, i in
+        zip(chroms, starts.tolist(), ends.tolist(), inds.tolist()))
+
+
+def _to_float(values):
+    """Get float array of position column, with NaN for non-numeric values."""
+    return pd.to_numeric(values, errors='coerce').to_numpy(dtype=float)
+
+
+def _build_col_lookup(df):
+    """Get (lowercase name, name) pairs for table columns, in order."""
+    return [(col.lower(), col) for col in df.columns]
+
+
+def _match_column_str(val=None, col_lookup=None):
+    """Get first column which, in lowercase, contains input text.
+
+    >>> _match_column_str('start', [('chromosome', 'Chromosome'),
+    ...                             ('start_position', 'Start_Position')])
+    'Start_Position'
+    """
+    for col_lower, col in col_lookup:
+        if val in col_lower:
+            return col
+    return None
 
 
 class BuildArgumentException(Exception):
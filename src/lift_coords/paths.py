@@ -8,6 +8,14 @@ _app_dirs = appdirs.AppDirs('lift_coords')
 DATA_ROOT = _app_dirs.user_data_dir
 CHAIN_DIR = pathlib.Path(DATA_ROOT).joinpath('data')
 WORK_DIR = pathlib.Path(DATA_ROOT).joinpath('temp')
+_dirs_ready = False
 
-os.makedirs(CHAIN_DIR, exist_ok=True)
-os.makedirs(WORK_DIR, exist_ok=True)
+
+def ensure_dirs():
+    """Create data directories, on first use rather than at import."""
+    global _dirs_ready
+    if _dirs_ready:
+        return
+    os.makedirs(CHAIN_DIR, exist_ok=True)
+    os.makedirs(WORK_DIR, exist_ok=True)
+    _dirs_ready = True
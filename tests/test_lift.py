@@ -0,0 +1,239 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+from lift_coords import lift_over
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "MIT"
+
+pytest.importorskip("pyliftover")
+
+needs_liftover = pytest.mark.skipif(
+    shutil.which("liftOver") is None, reason="liftOver binary not on PATH"
+)
+
+# (chrom, GRCh37 position, GRCh38 position): BRAF V600E, KRAS G12, TP53 R175H,
+# EGFR L858R
+KNOWN_SITES = [
+    ("7", 140453136, 140753336),
+    ("12", 25398284, 25245350),
+    ("17", 7578406, 7675088),
+    ("7", 55259515, 55191822),
+]
+
+
+# Stand-in for the liftOver binary, lifting with the in-process code. Like
+# liftOver it takes stdin/stdout as file names and is chatty on stderr.
+STUB_LIFTOVER = """\
+import os
+import sys
+
+from lift_coords.lift import _get_chain_index, _lift_interval
+
+bed_in, chain_path, bed_out, unmapped = sys.argv[1:]
+print("Reading liftover chains", file=sys.stderr)
+exit_code = int(os.environ.get("STUB_LIFTOVER_EXIT", "0"))
+if exit_code:
+    print("Can't open " + chain_path, file=sys.stderr)
+    sys.exit(exit_code)
+chain_index = _get_chain_index(chain_path)
+print("Mapping coordinates", file=sys.stderr)
+fin = sys.stdin if bed_in == "stdin" else open(bed_in)
+fout = sys.stdout if bed_out == "stdout" else open(bed_out, "w")
+with open(unmapped, "w") as fun:
+    for line in fin:
+        chrom, start, end, name = line.rstrip("\\n").split("\\t")
+        interval = _lift_interval(chain_index, chrom, int(start), int(end))
+        if interval is None:
+            fun.write(line)
+        else:
+            fout.write("{}\\t{}\\t{}\\t{}\\n".format(*interval, name))
+fout.flush()
+"""
+
+
+@pytest.fixture
+def stub_liftover(tmp_path, monkeypatch):
+    """Put stub liftOver first on PATH."""
+    script = tmp_path / "liftOver"
+    script.write_text(f"#!{sys.executable}\n" + STUB_LIFTOVER)
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:" + os.environ["PATH"])
+    return script
+
+
+def _sites_table(chroms, positions):
+    return pd.DataFrame(
+        {
+            "Chromosome": chroms,
+            "Start_Position": positions,
+            "End_Position": positions,
+        }
+    )
+
+
+def _mixed_table():
+    """Known GRCh38 sites plus rows that cannot lift."""
+    return pd.DataFrame(
+        {
+            "Chromosome": ["7", "1", "12", "no_such_chrom"],
+            "Start_Position": [140753336, 290000, 25245350, 1000],
+            # 1:290000-400000 runs across a gap into an inverted chain
+            "End_Position": [140753336, 400000, 25245350, 1000],
+        },
+        index=["a", "b", "c", "a"],
+    )
+
+
+def test_single_chain():
+    """GRCh37 -> GRCh38 lifts known sites"""
+    chroms, pos37, pos38 = zip(*KNOWN_SITES)
+    new_table, unlifted = lift_over(_sites_table(chroms, pos37), "grch37", "grch38")
+    assert unlifted.empty
+    assert new_table.Chromosome.tolist() == list(chroms)
+    assert new_table.Start_Position.tolist() == list(pos38)
+    assert new_table.End_Position.tolist() == list(pos38)
+
+
+def test_two_chains():
+    """hg38 -> GRCh37 lifts through hg19"""
+    chroms, pos37, pos38 = zip(*KNOWN_SITES)
+    df = _sites_table(["chr" + c for c in chroms], pos38)
+    new_table, unlifted = lift_over(df, "hg38", "grch37")
+    assert unlifted.empty
+    assert new_table.Chromosome.tolist() == list(chroms)
+    assert new_table.Start_Position.tolist() == list(pos37)
+
+
+def test_unlifted():
+    """Unmappable rows are returned separately, by position not label"""
+    new_table, unlifted = lift_over(_mixed_table(), "grch38", "grch37")
+    assert new_table.Start_Position.tolist() == [140453136, 25398284]
+    assert unlifted.Start_Position.tolist() == [290000, 1000]
+    assert unlifted.index.tolist() == ["b", "a"]
+
+
+def test_min_match():
+    """Lifting needs 95% of bases aligned, not an unchanged interval length"""
+    df = pd.DataFrame(
+        {
+            # 1:1566075-1566076 spans a gap only in GRCh38, X:134877331-134877350
+            # a 3bp gap in both builds (17/20 bases aligned)
+            "Chromosome": ["1", "X"],
+            "Start_Position": [1566075, 134877331],
+            "End_Position": [1566076, 134877350],
+        }
+    )
+    new_table, unlifted = lift_over(df, "grch37", "grch38")
+    assert new_table.Start_Position.tolist() == [1630695]
+    assert new_table.End_Position.tolist() == [1630697]
+    assert unlifted.Start_Position.tolist() == [134877331]
+
+
+def test_missing_positions():
+    """Rows without finite positions are unlifted rather than failing"""
+    df = _sites_table(["7", "12", "17"], [140453136, float("nan"), 7578406])
+    new_table, unlifted = lift_over(df, "grch37", "grch38")
+    assert new_table.Start_Position.tolist() == [140753336, 7675088]
+    assert unlifted.index.tolist() == [1]
+
+
+def test_empty():
+    """Empty tables and tables with nothing lifted keep integer positions"""
+    for df in [_mixed_table().iloc[:0], _mixed_table().iloc[[1, 3]]]:
+        new_table, unlifted = lift_over(df, "grch38", "grch37")
+        assert new_table.empty
+        assert len(unlifted) == len(df)
+        assert new_table.Start_Position.dtype == "int64"
+        assert new_table.End_Position.dtype == "int64"
+
+
+def test_keep_orig():
+    """keep_orig keeps original coordinates (and build) as {col}_orig"""
+    df = _sites_table(["7"], [140453136])
+    df["NCBI_Build"] = "GRCh37"
+    df["Hugo_Symbol"] = "BRAF"
+
+    new_table, _ = lift_over(df, "grch37", "grch38")
+    assert new_table.columns.tolist() == df.columns.tolist()
+
+    new_table, _ = lift_over(df, "grch37", "grch38", keep_orig=True)
+    assert new_table.columns.tolist() == [
+        "Chromosome_orig",
+        "Start_Position_orig",
+        "End_Position_orig",
+        "NCBI_Build_orig",
+        "Hugo_Symbol",
+        "Chromosome",
+        "Start_Position",
+        "End_Position",
+        "NCBI_Build",
+    ]
+    assert new_table.Start_Position_orig.tolist() == [140453136]
+    assert new_table.Start_Position.tolist() == [140753336]
+
+
+BINARY_KWARGS = [
+    {"use_subprocess": True},
+    {"use_subprocess": True, "parallel": True},
+    {"use_subprocess": True, "keep_intermediate": True},
+]
+
+
+def _check_backend(kwargs, builds):
+    df = _mixed_table()
+    if builds[0] == "hg38":
+        df["Chromosome"] = "chr" + df["Chromosome"]
+    expected, expected_unlifted = lift_over(df, *builds)
+    new_table, unlifted = lift_over(df, *builds, **kwargs)
+    pd.testing.assert_frame_equal(new_table, expected)
+    pd.testing.assert_frame_equal(unlifted, expected_unlifted)
+
+
+@pytest.mark.parametrize("kwargs", BINARY_KWARGS)
+@pytest.mark.parametrize("builds", [("grch38", "grch37"), ("hg38", "grch37")])
+def test_subprocess_backends(stub_liftover, kwargs, builds):
+    """liftOver subprocess backends agree with in-process lifting"""
+    _check_backend(kwargs, builds)
+
+
+@needs_liftover
+@pytest.mark.parametrize("kwargs", BINARY_KWARGS)
+@pytest.mark.parametrize("builds", [("grch38", "grch37"), ("hg38", "grch37")])
+def test_liftover_binary_matches(kwargs, builds):
+    """liftOver binary agrees with in-process lifting"""
+    _check_backend(kwargs, builds)
+
+
+@pytest.mark.parametrize("kwargs", BINARY_KWARGS)
+def test_subprocess_empty(stub_liftover, kwargs):
+    """Empty liftOver output gives an empty table with integer positions"""
+    df = _mixed_table().iloc[[1, 3]]
+    new_table, unlifted = lift_over(df, "grch38", "grch37", **kwargs)
+    assert new_table.empty
+    assert len(unlifted) == len(df)
+    assert new_table.Start_Position.dtype == "int64"
+
+
+def test_subprocess_stderr_logged(stub_liftover, caplog):
+    """liftOver stderr is logged for every hop"""
+    lift_over(_mixed_table(), "hg38", "grch37", use_subprocess=True)
+    messages = [r.getMessage() for r in caplog.records]
+    assert messages.count("LIFTOVER: Mapping coordinates") == 2
+
+
+@pytest.mark.parametrize("kwargs", BINARY_KWARGS)
+def test_subprocess_error(stub_liftover, monkeypatch, caplog, kwargs):
+    """A failing liftOver raises, with its stderr logged"""
+    monkeypatch.setenv("STUB_LIFTOVER_EXIT", "3")
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        lift_over(_mixed_table(), "hg38", "grch37", **kwargs)
+    assert excinfo.value.returncode == 3
+    assert any(r.getMessage().startswith("LIFTOVER: Can't open")
+               for r in caplog.records)